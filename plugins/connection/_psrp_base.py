@@ -1,103 +1,196 @@
 # Copyright (c) 2022 Ansible Project
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 
-import base64
-import io
+from __future__ import annotations
+
+import functools
 import re
 import typing as t
 
+from itertools import chain
+
 from ansible.errors import AnsibleError
 from ansible.plugins.connection import ConnectionBase
 from ansible.utils.display import Display
 
-
-HAS_PSRP = True
-PSRP_IMP_ERR = None
-try:
+if t.TYPE_CHECKING:
     import psrp
     import psrpcore.types
-except ImportError as err:
-    HAS_PSRP = False
-    PSRP_IMP_ERR = err
+else:
+    psrp = None
+    psrpcore = None
+
+try:
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from binascii import a2b_base64 as _b64decode
+
 
 display = Display()
 
 
-_COMMAND_PATTERN = re.compile(
-    "-EncodedCommand ((?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?)$"
+_COMMAND_MARKER = "-EncodedCommand "
+_RAW_COMMAND_SUFFIX = "\nexit $LASTEXITCODE"
+_B64_PATTERN = re.compile(
+    r"((?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?)\n?",
+    re.ASCII,
 )
 
 
-class PSHost(psrp.PSHost):
-    def __init__(
-        self,
-        ui: t.Optional[psrp.PSHostUI] = None,
-    ) -> None:
-        super().__init__(ui)
-        self.exit_code: int = 0
+def _get_encoded_command(
+    cmd: str,
+) -> t.Optional[bytes]:
+    """Gets the decoded -EncodedCommand value of cmd if present.
 
-    def set_should_exit(
-        self,
-        exit_code: int,
-    ) -> None:
-        self.exit_code = exit_code
+    A plain substring search finds the marker so the pattern only needs to
+    validate the base64 tail that follows it.
+    """
+    idx = cmd.rfind(_COMMAND_MARKER)
+    if idx == -1:
+        return None
 
+    if match := _B64_PATTERN.fullmatch(cmd, idx + len(_COMMAND_MARKER)):
+        # The pattern has validated the alphabet and padding already
+        return _b64decode(match[1])
 
-class PSHostUI(psrp.PSHostUI):
-    def __init__(
-        self,
-        raw_ui: t.Optional[psrp.PSHostRawUI] = None,
-    ):
-        super().__init__(raw_ui)
-        self.stdout = io.StringIO()
-        self.stderr = io.StringIO()
+    return None
 
-    def write(
-        self,
-        value: str,
-        *args: t.Any,
-        **kwargs: t.Any,
-    ) -> None:
-        self.stdout.write(value)
 
-    def write_debug_line(
-        self,
-        line: str,
-    ) -> None:
-        self.stdout.write(f"DEBUG: {line}\n")
+class _PSHost(t.Protocol):
+    exit_code: int
 
-    def write_error_line(
-        self,
-        line: str,
-    ) -> None:
-        self.stderr.write(line + "\n")
+    def reset(self) -> None: ...
 
-    def write_line(
-        self,
-        line: t.Optional[str] = None,
-        *args: t.Any,
-        **kwargs: t.Any,
-    ) -> None:
-        self.stdout.write((line or "") + "\n")
 
-    def write_verbose_line(
-        self,
-        line: str,
-    ) -> None:
-        self.stdout.write(f"VERBOSE: {line}\n")
+class _PSHostUI(t.Protocol):
+    stdout: t.List[str]
+    stderr: t.List[str]
 
-    def write_warning_line(
-        self,
-        line: str,
-    ) -> None:
-        self.stdout.write(f"WARNING: {line}\n")
+    def reset(self) -> None: ...
 
-    def write_progress(
-        self,
-        *args: t.Any,
-        **kwargs: t.Any,
-    ) -> None:
-        pass
+
+_HostTypes = t.Tuple[t.Callable[..., _PSHost], t.Callable[..., _PSHostUI]]
+_HOST_TYPES: t.Optional[_HostTypes] = None
+
+
+def _load_psrp() -> None:
+    """Imports psrp and psrpcore on first use.
+
+    psrp brings in a large set of dependencies so it is only imported once a
+    connection needs it rather than whenever the plugin is loaded. The modules
+    are bound to the module globals so the rest of the plugin can use them as
+    if they were imported normally.
+    """
+    global psrp, psrpcore
+
+    if psrp is not None:
+        return
+
+    try:
+        import psrpcore.types
+        import psrp
+    except ImportError as err:
+        raise AnsibleError(f"pypsrp or dependencies are not installed: {err}") from err
+
+
+def _get_host_types() -> _HostTypes:
+    """Gets the PSHost and PSHostUI classes.
+
+    The classes subclass the psrp types so they are created on first use
+    after psrp has been imported.
+    """
+    global _HOST_TYPES
+
+    if _HOST_TYPES is not None:
+        return _HOST_TYPES
+
+    _load_psrp()
+
+    class PSHost(psrp.PSHost):
+        __slots__ = ("exit_code",)
+
+        def __init__(
+            self,
+            ui: t.Optional[psrp.PSHostUI] = None,
+        ) -> None:
+            super().__init__(ui)
+            self.exit_code: int = 0
+
+        def set_should_exit(
+            self,
+            exit_code: int,
+        ) -> None:
+            self.exit_code = exit_code
+
+        def reset(self) -> None:
+            """Resets the host state for the next invocation."""
+            self.exit_code = 0
+
+    class PSHostUI(psrp.PSHostUI):
+        __slots__ = ("stdout", "stderr")
+
+        def __init__(
+            self,
+            raw_ui: t.Optional[psrp.PSHostRawUI] = None,
+        ):
+            super().__init__(raw_ui)
+            self.stdout: t.List[str] = []
+            self.stderr: t.List[str] = []
+
+        def reset(self) -> None:
+            """Clears the buffered output for the next invocation."""
+            self.stdout.clear()
+            self.stderr.clear()
+
+        def write(
+            self,
+            value: str,
+            *args: t.Any,
+            **kwargs: t.Any,
+        ) -> None:
+            self.stdout.append(value)
+
+        def write_debug_line(
+            self,
+            line: str,
+        ) -> None:
+            self.stdout.append(f"DEBUG: {line}\n")
+
+        def write_error_line(
+            self,
+            line: str,
+        ) -> None:
+            self.stderr.append(f"{line}\n")
+
+        def write_line(
+            self,
+            line: t.Optional[str] = None,
+            *args: t.Any,
+            **kwargs: t.Any,
+        ) -> None:
+            self.stdout.append(f"{line or ''}\n")
+
+        def write_verbose_line(
+            self,
+            line: str,
+        ) -> None:
+            self.stdout.append(f"VERBOSE: {line}\n")
+
+        def write_warning_line(
+            self,
+            line: str,
+        ) -> None:
+            self.stdout.append(f"WARNING: {line}\n")
+
+        def write_progress(
+            self,
+            *args: t.Any,
+            **kwargs: t.Any,
+        ) -> None:
+            pass
+
+    _HOST_TYPES = (PSHost, PSHostUI)
+    return _HOST_TYPES
 
 
 class PSRPBaseConnection(ConnectionBase):
@@ -113,9 +206,8 @@ class PSRPBaseConnection(ConnectionBase):
         self.always_pipeline_modules = True
         self.has_native_async = True
         self._shell_type = "powershell"
-        self._ps_host_ui = PSHostUI()
-        self._ps_host = PSHost(ui=self._ps_host_ui)
         self._runspace: t.Optional[psrp.SyncRunspacePool] = None
+        self._conn_info: t.Optional[psrp.ConnectionInfo] = None
         self._connected = False
 
         super().__init__(*args, **kwargs)
@@ -126,62 +218,77 @@ class PSRPBaseConnection(ConnectionBase):
         in_data: t.Optional[bytes] = None,
         sudoable: bool = True,
     ) -> t.Tuple[int, bytes, bytes]:
-        input_data: t.Optional[str] = in_data.decode() if in_data else None
+        if (encoded_cmd := _get_encoded_command(cmd)) is not None:
+            return self._exec_encoded(encoded_cmd, in_data)
 
-        runspace = self._get_runspace()
-        ps = psrp.SyncPowerShell(runspace)
+        return self._exec_raw(cmd, in_data)
 
-        if b64cmd := _COMMAND_PATTERN.search(cmd):
-            script = base64.b64decode(b64cmd[1]).decode("utf-16-le")
-            display.vvv(f"PSRP: EXEC {script}")
-            ps.add_script(script)
-
-            if input_data and input_data.startswith("#!"):
-                # ANSIBALLZ wrapper, we need to get the interpreter and execute
-                # that as the script - note this won't work as basic.py relies
-                # on packages not available on Windows, once fixed we can enable
-                # this path
-                # script = "$input | &'%s' -" % interpreter
-                # in_data = to_text(in_data)
-                interpreter = input_data.splitlines()[0][2:]
-                raise AnsibleError(
-                    f"cannot run the interpreter '{interpreter}' on the "
-                    f"{self.transport} connection plugin"
-                )
-
-        else:
-            script = f"{cmd}\nexit $LASTEXITCODE"
-            display.vvv(f"PSRP: EXEC {script}")
-            ps.add_script(script)
+    def _exec_encoded(
+        self,
+        encoded_cmd: bytes,
+        in_data: t.Optional[bytes],
+    ) -> t.Tuple[int, bytes, bytes]:
+        if in_data and in_data.startswith(b"#!"):
+            # ANSIBALLZ wrapper, we need to get the interpreter and execute
+            # that as the script - note this won't work as basic.py relies
+            # on packages not available on Windows, once fixed we can enable
+            # this path
+            # script = "$input | &'%s' -" % interpreter
+            # in_data = to_text(in_data)
+            nl = in_data.find(b"\n", 2)
+            interpreter = (
+                (in_data[2:nl] if nl != -1 else in_data[2:]).rstrip(b"\r").decode()
+            )
+            raise AnsibleError(
+                f"cannot run the interpreter '{interpreter}' on the "
+                f"{self.transport} connection plugin"
+            )
 
-        output = ps.invoke(input_data=[input_data])
+        script = encoded_cmd.decode("utf-16-le", "surrogatepass")
+        return self._invoke_script(script, in_data)
 
-        stdout: t.List[str] = []
-        stderr: t.List[str] = []
-        rc = self._ps_host.exit_code or (1 if ps.had_errors else 0)
+    def _exec_raw(
+        self,
+        cmd: str,
+        in_data: t.Optional[bytes],
+    ) -> t.Tuple[int, bytes, bytes]:
+        return self._invoke_script(cmd + _RAW_COMMAND_SUFFIX, in_data)
 
-        for out in output:
-            stdout.append(str(out))
+    def _invoke_script(
+        self,
+        script: str,
+        in_data: t.Optional[bytes],
+    ) -> t.Tuple[int, bytes, bytes]:
+        runspace = self._get_runspace()
+        host = self._ps_host
+        host_ui = self._ps_host_ui
+        ps = psrp.SyncPowerShell(runspace)
 
-        if host_stdout := self._ps_host_ui.stdout.getvalue():
-            stdout.append(host_stdout)
+        if display.verbosity >= 3:
+            display.vvv(f"PSRP: EXEC {script}")
+        ps.add_script(script)
 
-        for err in ps.streams.error:
-            stderr.append(str(err))
+        input_data: t.Optional[str] = in_data.decode() if in_data else None
+        output = ps.invoke(input_data=[input_data])
 
-        if host_stderr := self._ps_host_ui.stderr.getvalue():
-            stderr.append(host_stderr)
+        rc = host.exit_code or (1 if ps.had_errors else 0)
+        host_stdout = "".join(host_ui.stdout)
+        host_stderr = "".join(host_ui.stderr)
 
         # Reset for the next invocation
-        self._ps_host.exit_code = 0
-        self._ps_host_ui.stdout = io.StringIO()
-        self._ps_host_ui.stderr = io.StringIO()
-
-        stdout_str = "\n".join(stdout)
-        stderr_str = "\n".join(stderr)
-        display.vvvvv("PSRP RC: %d" % rc)
-        display.vvvvv("PSRP STDOUT: %s" % stdout_str)
-        display.vvvvv("PSRP STDERR: %s" % stderr_str)
+        host.reset()
+        host_ui.reset()
+
+        stdout_str = "\n".join(
+            chain(map(str, output), (host_stdout,) if host_stdout else ())
+        )
+        stderr_str = "\n".join(
+            chain(map(str, ps.streams.error), (host_stderr,) if host_stderr else ())
+        )
+        if display.verbosity >= 5:
+            display.vvvvv(f"PSRP RC: {rc}")
+            display.vvvvv(f"PSRP STDOUT: {stdout_str}")
+            display.vvvvv(f"PSRP STDERR: {stderr_str}")
 
         return rc, stdout_str.encode(), stderr_str.encode()
 
@@ -213,25 +320,24 @@ class PSRPBaseConnection(ConnectionBase):
         self._connected = False
 
     def reset(self) -> None:
-        if not self._connected:
-            return
-
+        # The next operation will open a new Runspace Pool as needed, the
+        # connection info is rebuilt in case the options have changed.
+        self._conn_info = None
         self.close()
-        self._get_runspace()
 
     def _connect(self) -> None:
         return None  # Work is done in _get_runspace as needed
 
     def _get_runspace(self) -> psrp.SyncRunspacePool:
-        if not HAS_PSRP:
-            raise AnsibleError(
-                f"pypsrp or dependencies are not installed: {PSRP_IMP_ERR}"
-            )
-
         if not self._runspace:
+            _load_psrp()
+
+            if self._conn_info is None:
+                self._conn_info = self._get_connection_info()
+
             self._runspace = psrp.SyncRunspacePool(
-                self._get_connection_info(),
-                host=self._ps_host,
+                self._conn_info,
+                host=t.cast(psrp.PSHost, self._ps_host),
             )
             display.vvv(f"ESTABLISHING {self.transport} CONNECTION")
             self._runspace.open()
@@ -239,6 +345,14 @@ class PSRPBaseConnection(ConnectionBase):
 
         return self._runspace
 
+    @functools.cached_property
+    def _ps_host_ui(self) -> _PSHostUI:
+        return _get_host_types()[1]()
+
+    @functools.cached_property
+    def _ps_host(self) -> _PSHost:
+        return _get_host_types()[0](ui=self._ps_host_ui)
+
     def _get_connection_info(self) -> psrp.ConnectionInfo:
         """Implemented by sub classes to generated the connection info."""
         raise NotImplementedError()
@@ -1,6 +1,8 @@
 # Copyright (c) 2022 Ansible Project
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+from __future__ import annotations
+
 DOCUMENTATION = """
 author: jborean93
 name: psrp_local
@@ -11,6 +13,7 @@ description:
   without having to set up WinRM.
 requirements:
 - pypsrp>=1.0.0 (Python library)
+- pybase64 (optional Python library, speeds up decoding large commands)
 options:
   executable:
     description:
@@ -34,13 +37,21 @@ options:
     - name: ansible_psrp2_local_arguments
 """
 
-from ._psrp_base import PSRPBaseConnection, psrp
+import typing as t
+
+from ._psrp_base import PSRPBaseConnection
+
+if t.TYPE_CHECKING:
+    import psrp
 
 
 class Connection(PSRPBaseConnection):
     transport = "jborean93.psrp.psrp_local"
 
     def _get_connection_info(self) -> psrp.ConnectionInfo:
+        # Only called by _get_runspace once psrp has been loaded
+        import psrp
+
         return psrp.ProcessInfo(
             executable=self.get_option("executable"),
             arguments=self.get_option("arguments"),
@@ -1,6 +1,8 @@
 # Copyright (c) 2022 Ansible Project
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+from __future__ import annotations
+
 DOCUMENTATION = """
 author: jborean93
 name: psrp_winrm
@@ -9,6 +11,7 @@ description:
 - Runs commands or put/fetch on a target via a WinRM PSRP connection.
 requirements:
 - pypsrp>=1.0.0 (Python library)
+- pybase64 (optional Python library, speeds up decoding large commands)
 options:
   hostname:
     description:
@@ -83,13 +86,21 @@ options:
     - name: ansible_psrp2_winrm_cert_validation
 """
 
-from ._psrp_base import PSRPBaseConnection, psrp
+import typing as t
+
+from ._psrp_base import PSRPBaseConnection
+
+if t.TYPE_CHECKING:
+    import psrp
 
 
 class Connection(PSRPBaseConnection):
     transport = "jborean93.psrp.psrp_wsman"
 
     def _get_connection_info(self) -> psrp.ConnectionInfo:
+        # Only called by _get_runspace once psrp has been loaded
+        import psrp
+
         hostname = self.get_option("hostname")
         remote_user = self.get_option("remote_user")
         remote_pass = self.get_option("remote_password")
@@ -0,0 +1,73 @@
+# Copyright (c) 2022 Ansible Project
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import base64
+import re
+import typing as t
+
+import pytest
+
+from ansible_collections.jborean93.psrp.plugins.connection._psrp_base import (
+    _get_encoded_command,
+)
+
+# The pattern used before the marker search replaced it, _get_encoded_command
+# should accept exactly the same commands.
+_BASELINE_PATTERN = re.compile(
+    "-EncodedCommand ((?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?)$"
+)
+
+SCRIPT = "Write-Output 'café'"
+B64 = base64.b64encode(SCRIPT.encode("utf-16-le")).decode()
+
+
+def _baseline(cmd: str) -> t.Optional[bytes]:
+    if match := _BASELINE_PATTERN.search(cmd):
+        return base64.b64decode(match[1])
+
+    return None
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    [
+        f"powershell -NoProfile -EncodedCommand {B64}",
+        f"-EncodedCommand {B64}",
+        f"powershell -EncodedCommand {B64}\n",
+        "powershell -EncodedCommand QQ==",
+        "powershell -EncodedCommand QUI=",
+        "powershell -EncodedCommand ",
+    ],
+)
+def test_get_encoded_command(cmd: str) -> None:
+    actual = _get_encoded_command(cmd)
+
+    assert actual is not None
+    assert actual == _baseline(cmd)
+
+
+def test_get_encoded_command_decodes_script() -> None:
+    actual = _get_encoded_command(f"powershell -EncodedCommand {B64}")
+
+    assert actual is not None
+    assert actual.decode("utf-16-le") == SCRIPT
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    [
+        "Get-Item C:\\Windows",
+        f"powershell -EncodedCommand {B64} ",
+        f"powershell -EncodedCommand {B64}\t\n",
+        f"powershell -EncodedCommand {B64}\n\n",
+        f"Write-Output '-EncodedCommand {B64}'",
+        "powershell -EncodedCommand abc",
+        "powershell -EncodedCommand QQ=",
+        "powershell -EncodedCommand QQ==QQ==",
+        "powershell -EncodedCommand Q-Q=",
+        "powershell -encodedcommand QQ==",
+    ],
+)
+def test_get_encoded_command_no_match(cmd: str) -> None:
+    assert _get_encoded_command(cmd) is None
+    assert _baseline(cmd) is None